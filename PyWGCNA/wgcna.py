@@ -4,15 +4,15 @@ from time import sleep
 import numpy as np
 import pandas as pd
 import scipy.stats as stats
-import statistics
 import sys
 import warnings
-from scipy.spatial.distance import pdist, squareform
+from concurrent.futures import ThreadPoolExecutor
+from scipy.spatial.distance import pdist, squareform, num_obs_y
 from scipy.cluster.hierarchy import linkage, cut_tree, dendrogram, fcluster
 from scipy.cluster.hierarchy import to_tree
 from scipy.stats import t
 from scipy.stats import rankdata
-from statsmodels.formula.api import ols
+from scipy.special import stdtr
 from matplotlib import colors as mcolors
 from sklearn.impute import KNNImputer
 from sklearn.preprocessing import scale
@@ -37,6 +37,18 @@ except ImportError:
     except ImportError:
         sys.exit("resource or rsrc package is not installed!")
 
+# numba is optional; without it the connectivity is accumulated with plain numpy
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# numexpr is optional; without it the gene and sample filters are combined with numpy
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
+
 # remove runtime warning (divided by zero)
 np.seterr(divide='ignore', invalid='ignore')
 warnings.simplefilter(action='ignore', category=FutureWarning)
@@ -66,6 +78,65 @@ ENDC = "\033[0m"
 BOLD = "\033[1m"
 UNDERLINE = "\033[4m"
 
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True, nogil=True)
+    def _accumulate_k(corx, powerSteps):
+        """
+        connectivity of each column of corx for every power, walking the sorted powers in one pass over corx
+        """
+        nRows, nCols = corx.shape
+        nPowers = powerSteps.shape[0]
+        chunk = 64
+        datk_local = np.zeros((nCols, nPowers))
+        for c in prange((nCols + chunk - 1) // chunk):
+            start = c * chunk
+            end = min(start + chunk, nCols)
+            for i in range(nRows):
+                for g in range(start, end):
+                    cur = 1.0
+                    for j in range(nPowers):
+                        cur *= corx[i, g] ** powerSteps[j]
+                        datk_local[g, j] += cur
+        # remove the self-edge
+        return datk_local - 1
+
+    # NaN checks must survive, so fastmath is used without the 'nnan' and 'ninf' flags
+    @njit(parallel=True, fastmath={'nsz', 'arcp', 'contract', 'afn', 'reassoc'}, cache=True, nogil=True)
+    def _block_k(Zt, powerSteps, startG, endG, intType):
+        """
+        connectivity of genes startG to endG for every power, computing each correlation from the standardized
+        genes (rows of Zt) and passing it through the power ladder without storing the correlation matrix
+        """
+        nGenes, nSamples = Zt.shape
+        nPowers = powerSteps.shape[0]
+        datk_local = np.zeros((endG - startG, nPowers))
+        for g in prange(startG, endG):
+            acc = np.zeros(nPowers)
+            for i in range(nGenes):
+                if i == g:
+                    c = 1.0
+                else:
+                    c = 0.0
+                    for s in range(nSamples):
+                        c += Zt[i, s] * Zt[g, s]
+                    c /= nSamples - 1
+                    if intType == 0:
+                        c = abs(c)
+                    elif intType == 1:
+                        c = 0.5 + 0.5 * c
+                    elif c < 0:
+                        c = 0.0
+                    # missing correlations do not contribute to the connectivity
+                    if c != c:
+                        c = 0.0
+                cur = 1.0
+                for j in range(nPowers):
+                    cur *= c ** powerSteps[j]
+                    acc[j] += cur
+            # remove the self-edge
+            datk_local[g - startG, :] = acc - 1
+        return datk_local
+
 class WGCNA(GeneExp):
     """
     A class used to do weighted gene co-expression network analysis.
@@ -268,13 +339,17 @@ class WGCNA(GeneExp):
         """
         print(f"{BOLD}{OKBLUE}Run WGCNA...{ENDC}")
 
+        # standardize the expression data once and share it between pickSoftThreshold and adjacency
+        datExpr = self.datExpr.to_df()
+        Z = WGCNA._standardizedExpr(datExpr)
+
         # Call the network topology analysis function
         kwargs = dict()
         if 'pickSoftThreshold' in list(kwargs_function.keys()):
             kwargs = kwargs_function['pickSoftThreshold']
-        self.power, self.sft = WGCNA.pickSoftThreshold(self.datExpr.to_df(), RsquaredCut=self.RsquaredCut,
+        self.power, self.sft = WGCNA.pickSoftThreshold(datExpr, RsquaredCut=self.RsquaredCut,
                                                        MeanCut=self.MeanCut, powerVector=self.powers,
-                                                       networkType=self.networkType, **kwargs)
+                                                       networkType=self.networkType, _Z=Z, **kwargs)
 
         fig, ax = plt.subplots(ncols=2, figsize=(10, 5), facecolor='white')
         ax[0].plot(self.sft['Power'], -1 * np.sign(self.sft['slope']) * self.sft['SFT.R.sq'], 'o')
@@ -303,7 +378,8 @@ class WGCNA(GeneExp):
         kwargs = dict()
         if 'adjacency' in list(kwargs_function.keys()):
             kwargs = kwargs_function['adjacency']
-        self.adjacency = WGCNA.adjacency(self.datExpr.to_df(), power=self.power, adjacencyType=self.networkType, **kwargs)
+        self.adjacency = WGCNA.adjacency(datExpr, power=self.power, adjacencyType=self.networkType, _Z=Z, **kwargs)
+        del Z
         self.adjacency = pd.DataFrame(self.adjacency,
                                       columns=self.datExpr.to_df().columns,
                                       index=self.datExpr.to_df().columns)
@@ -508,26 +584,27 @@ class WGCNA(GeneExp):
         :type scaleByMax: boll
 
         :return: processed weights of gene expression
-        :rtype: pandas dataframe
+        :rtype: ndarray
         """
         if weights is None:
             return weights
 
-        weights = np.asmatrix(weights)
+        # copy, so the caller's weights are not modified in place below
+        weights = np.array(weights, dtype=np.float64)
         if expr.shape != weights.shape:
             sys.exit("When 'weights' are given, they must have the same dimensions as 'expr'.")
-        if (weights < 0).any():
+        if np.any(weights < 0):
             sys.exit("Found negative weights. All weights must be non-negative.")
 
-        nf = np.isinf(weights)
-        if any(nf):
+        nf = ~np.isfinite(weights)
+        if nf.any():
             print(f"{WARNING}Found non-finite weights. The corresponding data points will be removed.{ENDC}")
-            weights[nf] = None
+            weights[nf] = np.nan
 
         if scaleByMax:
-            maxw = np.amax(weights, axis=0)
+            maxw = weights.max(axis=0)
             maxw[maxw == 0] = 1
-            weights = weights / np.reshape(maxw, weights.shape)
+            weights /= maxw
 
         return weights
 
@@ -563,14 +640,63 @@ class WGCNA(GeneExp):
         changed = True
         iter = 1
         print("\tDetecting genes and samples with too many missing values...", flush=True)
-        while changed:
-            goodGenes = WGCNA.goodGenesFun(datExpr, weights, goodSamples, goodGenes, minFraction=minFraction,
-                                           minNSamples=minNSamples, minNGenes=minNGenes,
-                                           minRelativeWeight=minRelativeWeight,
-                                           tol=tol)
-            goodSamples = WGCNA.goodSamplesFun(datExpr, weights, goodSamples, goodGenes, minFraction=minFraction,
+        if weights is not None:
+            while changed:
+                goodGenes = WGCNA.goodGenesFun(datExpr, weights, goodSamples, goodGenes, minFraction=minFraction,
                                                minNSamples=minNSamples, minNGenes=minNGenes,
-                                               minRelativeWeight=minRelativeWeight)
+                                               minRelativeWeight=minRelativeWeight,
+                                               tol=tol)
+                goodSamples = WGCNA.goodSamplesFun(datExpr, weights, goodSamples, goodGenes, minFraction=minFraction,
+                                                   minNSamples=minNSamples, minNGenes=minNGenes,
+                                                   minRelativeWeight=minRelativeWeight)
+                changed = np.logical_or((np.logical_not(goodGenes).sum() > nBadGenes),
+                                        (np.logical_not(goodSamples).sum() > nBadSamples))
+                nBadGenes = np.logical_not(goodGenes).sum()
+                nBadSamples = np.logical_not(goodSamples).sum()
+                iter = iter + 1
+
+            allOK = (nBadGenes + nBadSamples == 0)
+
+            return goodGenes, goodSamples, allOK
+
+        arr = datExpr.to_numpy()
+        if not np.issubdtype(arr.dtype, np.number):
+            if not datExpr.apply(lambda s: pd.to_numeric(s, errors='coerce').notnull().all()).all():
+                sys.exit("datExpr must contain numeric data.")
+            arr = arr.astype(float)
+        if tol is None:
+            tol = 1e-10 * np.nanmax(np.abs(arr))
+
+        # per gene and per sample counts of non-missing entries are computed once and then only updated with the
+        # contribution of genes and samples dropped in each iteration. The gene variances are recomputed over the
+        # remaining samples only when samples were dropped, so genes constant on those samples are still caught.
+        notna = ~np.isnan(arr)
+        rowNotNA = notna.sum(axis=1)
+        colNotNA = notna.sum(axis=0)
+        goodGenes = np.repeat(True, datExpr.shape[0])
+        goodSamples = np.repeat(True, datExpr.shape[1])
+        var = None
+        while changed:
+            nSamples = np.sum(goodSamples)
+            if var is None:
+                var = np.nanvar(arr[:, goodSamples], axis=1)
+                var[np.isnan(var)] = 0
+            newGenes = WGCNA._goodGenes(rowNotNA, nSamples - rowNotNA, var, goodGenes, nSamples,
+                                        minFraction=minFraction, minNSamples=minNSamples, minNGenes=minNGenes,
+                                        tol=tol)
+            dropped = np.logical_and(goodGenes, np.logical_not(newGenes))
+            colNotNA -= notna[dropped, :].sum(axis=0)
+            goodGenes = newGenes
+
+            nGenes = np.sum(goodGenes)
+            newSamples = WGCNA._goodSamples(nGenes - colNotNA[goodSamples], goodSamples, nGenes,
+                                            minFraction=minFraction, minNSamples=minNSamples, minNGenes=minNGenes)
+            dropped = np.logical_and(goodSamples, np.logical_not(newSamples))
+            rowNotNA -= notna[:, dropped].sum(axis=1)
+            if dropped.any():
+                var = None
+            goodSamples = newSamples
+
             changed = np.logical_or((np.logical_not(goodGenes).sum() > nBadGenes),
                                     (np.logical_not(goodSamples).sum() > nBadSamples))
             nBadGenes = np.logical_not(goodGenes).sum()
@@ -610,13 +736,16 @@ class WGCNA(GeneExp):
         :return: A logical list with one entry per gene that is TRUE if the gene is considered good and FALSE otherwise. Note that all genes excluded by useGenes are automatically assigned FALSE.
         :rtype: list of bool
         """
-        if not datExpr.apply(lambda s: pd.to_numeric(s, errors='coerce').notnull().all()).all():
-            sys.exit("datExpr must contain numeric data.")
+        arr = datExpr.to_numpy()
+        if not np.issubdtype(arr.dtype, np.number):
+            if not datExpr.apply(lambda s: pd.to_numeric(s, errors='coerce').notnull().all()).all():
+                sys.exit("datExpr must contain numeric data.")
+            arr = arr.astype(float)
 
         weights = WGCNA.checkAndScaleWeights(weights, datExpr, scaleByMax=True)
 
         if tol is None:
-            tol = 1e-10 * datExpr.abs().max().max()
+            tol = 1e-10 * np.nanmax(np.abs(arr))
         if useGenes is None:
             useGenes = np.repeat(True, datExpr.shape[0])
         if useSamples is None:
@@ -627,47 +756,24 @@ class WGCNA(GeneExp):
         if len(useSamples) != datExpr.shape[1]:
             sys.exit("Length of nSamples is not compatible with number of rows in datExpr.")
 
-        nSamples = sum(useSamples)
-        nGenes = sum(useGenes)
-        if weights is None:
-            nPresent = datExpr.loc[useGenes, useSamples].notna().sum(axis=1)
-        else:
-            nPresent = (datExpr.loc[useGenes, useSamples].notna() and
-                        weights.loc[useGenes, useSamples] > minRelativeWeight).sum(axis=1)
-
-        gg = useGenes.copy()
-        if len(useGenes) != len(nPresent):
-            tmp = list(useGenes.copy())
-            ind = [i for i in range(len(tmp)) if tmp[i]]
-            tmp = pd.Series(data=tmp)
-            index = np.asarray(tmp.index.tolist(), dtype=object)
-            index[ind] = nPresent.index.tolist()
-            tmp.index = index
-            tmp.loc[nPresent.index] = nPresent.values
-            nPresent = tmp.copy()
-
-        gg[np.logical_and(useGenes, nPresent < minNSamples)] = False
+        nSamples = np.sum(useSamples)
+        notna = ~np.isnan(arr[:, useSamples])
+        present = notna
+        if weights is not None:
+            present = np.logical_and(notna, np.asarray(weights)[:, useSamples] > minRelativeWeight)
 
         if weights is None:
-            var = np.var(datExpr.loc[gg, useSamples], axis=1)
-            # var = var.sort_index(inplace=True)
+            var = np.nanvar(arr[:, useSamples], axis=1)
         else:
             # need to be fix
             # TODO:colWeightedVars
             var = np.var(datExpr, w=weights)
 
-        var[pd.isnull(var)] = 0
-        nNAsGenes = datExpr.loc[gg, useSamples].isna().sum(axis=1)
-        gg[gg] = np.logical_and(np.logical_and(nNAsGenes < (1 - minFraction) * nSamples, var > tol ** 2),
-                                nSamples - nNAsGenes >= minNSamples)
+        var[np.isnan(var)] = 0
+        nNAsGenes = nSamples - notna.sum(axis=1)
 
-        if sum(gg) < minNGenes:
-            sys.exit("Too few genes with valid expression levels in the required number of samples.")
-        if nGenes - sum(gg) > 0:
-            print("\n\n  ..Excluding", nGenes - sum(gg),
-                  "genes from the calculation due to too many missing samples or zero variance.\n\n", flush=True)
-
-        return gg
+        return WGCNA._goodGenes(present.sum(axis=1), nNAsGenes, var, useGenes, nSamples, minFraction=minFraction,
+                                minNSamples=minNSamples, minNGenes=minNGenes, tol=tol)
 
     # Filter samples with too many missing entries
     @staticmethod
@@ -709,43 +815,112 @@ class WGCNA(GeneExp):
             sys.exit("Length of nSamples is not compatible with number of rows in datExpr.")
 
         weights = WGCNA.checkAndScaleWeights(weights, datExpr, scaleByMax=True)
-        nSamples = sum(useSamples)
-        nGenes = sum(useGenes)
+        nGenes = np.sum(useGenes)
         if weights is None:
-            nNAsSamples = np.sum((datExpr.loc[useGenes, useSamples]).isnull(), axis=0)
+            # pd.isna also handles object arrays, which np.isnan rejects
+            nNAsSamples = pd.isna(datExpr.to_numpy()[np.ix_(useGenes, useSamples)]).sum(axis=0)
         else:
             nNAsSamples = np.sum(np.logical_or(datExpr[useGenes, useSamples],
                                                WGCNA.replaceMissing(weights[useGenes, useSamples] < minRelativeWeight,
                                                                     True))
                                  .isnull(), axis=0)
 
-        goodSamples = useSamples
-        goodSamples[useSamples] = np.logical_and((nNAsSamples < (1 - minFraction) * nGenes),
-                                                 (nGenes - nNAsSamples >= minNGenes))
+        return WGCNA._goodSamples(nNAsSamples, useSamples, nGenes, minFraction=minFraction, minNSamples=minNSamples,
+                                  minNGenes=minNGenes)
+
+    @staticmethod
+    def _goodGenes(nPresent, nNAsGenes, var, useGenes, nSamples, minFraction=1 / 2, minNSamples=4, minNGenes=4,
+                   tol=0):
+        """
+        flag good genes from per gene counts and variances over the used samples (see goodGenesFun)
+
+        :param nPresent: number of present (and sufficiently weighted) entries of each gene
+        :type nPresent: ndarray
+        :param nNAsGenes: number of missing entries of each gene
+        :type nNAsGenes: ndarray
+        :param var: variance of each gene
+        :type var: ndarray
+        :param useGenes: genes for which to perform the check
+        :type useGenes: list of bool
+        :param nSamples: number of used samples
+        :type nSamples: int
+
+        :return: A logical list with one entry per gene that is TRUE if the gene is considered good and FALSE otherwise.
+        :rtype: list of bool
+        """
+        nGenes = np.sum(useGenes)
+        gg = useGenes.copy()
+        gg[np.logical_and(useGenes, nPresent < minNSamples)] = False
+
+        nNAsGenes = nNAsGenes[gg]
+        var = var[gg]
+        if ne is not None:
+            gg[gg] = ne.evaluate('(nNAsGenes < thr) & (var > tol2) & ((nSamples - nNAsGenes) >= minNSamples)',
+                                 local_dict={'nNAsGenes': nNAsGenes, 'var': var, 'thr': (1 - minFraction) * nSamples,
+                                             'tol2': tol ** 2, 'nSamples': nSamples, 'minNSamples': minNSamples})
+        else:
+            gg[gg] = np.logical_and(np.logical_and(nNAsGenes < (1 - minFraction) * nSamples, var > tol ** 2),
+                                    nSamples - nNAsGenes >= minNSamples)
+
+        if np.sum(gg) < minNGenes:
+            sys.exit("Too few genes with valid expression levels in the required number of samples.")
+        if nGenes - np.sum(gg) > 0:
+            print("\n\n  ..Excluding", nGenes - np.sum(gg),
+                  "genes from the calculation due to too many missing samples or zero variance.\n\n", flush=True)
+
+        return gg
 
-        if sum(goodSamples) < minNSamples:
+    @staticmethod
+    def _goodSamples(nNAsSamples, useSamples, nGenes, minFraction=1 / 2, minNSamples=4, minNGenes=4):
+        """
+        flag good samples from per sample counts of missing entries over the used genes (see goodSamplesFun)
+
+        :param nNAsSamples: number of missing entries of each used sample
+        :type nNAsSamples: ndarray
+        :param useSamples: samples for which to perform the check
+        :type useSamples: list of bool
+        :param nGenes: number of used genes
+        :type nGenes: int
+
+        :return: A logical list with one entry per sample that is TRUE if the sample is considered good and FALSE otherwise.
+        :rtype: list of bool
+        """
+        nSamples = np.sum(useSamples)
+        goodSamples = useSamples.copy()
+        if ne is not None:
+            goodSamples[useSamples] = ne.evaluate('(nNAsSamples < thr) & ((nGenes - nNAsSamples) >= minNGenes)',
+                                                  local_dict={'nNAsSamples': nNAsSamples,
+                                                              'thr': (1 - minFraction) * nGenes, 'nGenes': nGenes,
+                                                              'minNGenes': minNGenes})
+        else:
+            goodSamples[useSamples] = np.logical_and((nNAsSamples < (1 - minFraction) * nGenes),
+                                                     (nGenes - nNAsSamples >= minNGenes))
+
+        if np.sum(goodSamples) < minNSamples:
             sys.exit("Too few samples with valid expression levels for the required number of genes.")
 
-        if nSamples - sum(goodSamples) > 0:
-            print("  ..Excluding", nSamples - sum(goodSamples),
+        if nSamples - np.sum(goodSamples) > 0:
+            print("  ..Excluding", nSamples - np.sum(goodSamples),
                   "samples from the calculation due to too many missing genes.", flush=True)
 
         return goodSamples
 
     @staticmethod
-    def hclust(d, method="complete"):
+    def hclust(d, method="complete", optimal_ordering=False):
         """
         Hierarchical cluster analysis on a set of dissimilarities and methods for analyzing it.
 
-        :param d: a dissimilarity structure as produced by 'pdist'.
+        :param d: a dissimilarity structure as produced by 'pdist' or a square (symmetric, zero diagonal) dissimilarity matrix. Passing condensed float64 distances avoids any conversion.
         :type d: ndarray
-        :param method: The linkage algorithm to use. (default = complete)
+        :param method: The linkage algorithm to use. "centroid" and "median" use scipy's generic algorithm (O(N^3) in the worst case), the others a O(N^2) one. (default = complete)
         :type method: str
+        :param optimal_ordering: reorder the linkage matrix so that the distance between successive leaves is minimal. This is slow for large data sets. (default = False)
+        :type optimal_ordering: bool
 
         :return: The hierarchical clustering encoded as a linkage matrix.
         :rtype: ndarray
         """
-        METHODS = ["single", "complete", "average", "weighted", "centroid"]
+        METHODS = ["single", "complete", "average", "weighted", "centroid", "median", "ward"]
 
         if method not in METHODS:
             sys.exit("Invalid clustering method.")
@@ -753,7 +928,18 @@ class WGCNA(GeneExp):
         if method == -1:
             sys.exit("Ambiguous clustering method.")
 
-        dendrogram = linkage(d, method=method)
+        d = np.asarray(d)
+        # a square dissimilarity matrix would otherwise be taken as observations and run through pdist again
+        if d.ndim == 2 and d.shape[0] == d.shape[1] and not np.any(np.diag(d)) and np.allclose(d, d.T):
+            d = squareform(np.ascontiguousarray(d, dtype=np.float64), checks=False)
+
+        nObs = num_obs_y(d) if d.ndim == 1 else d.shape[0]
+        if method in ["centroid", "median"] and nObs > 2000:
+            print(f"{WARNING}'{method}' linkage uses a O(N^3) worst-case algorithm which can be slow for {nObs} "
+                  f"observations; consider 'average' or 'ward', which use the O(N^2) nearest-neighbor chain "
+                  f"algorithm.{ENDC}")
+
+        dendrogram = linkage(d, method=method, optimal_ordering=optimal_ordering)
 
         return dendrogram
 
@@ -780,7 +966,7 @@ class WGCNA(GeneExp):
     def pickSoftThreshold(data, dataIsExpr=True, weights=None, RsquaredCut=0.9, MeanCut=100, powerVector=None,
                           nBreaks=10,
                           blockSize=None, corOptions=None, networkType="unsigned", moreNetworkConcepts=False,
-                          gcInterval=None):
+                          gcInterval=None, lowMemory=False, _Z=None):
         """
         Analysis of scale free topology for multiple soft thresholding powers.
 
@@ -800,7 +986,7 @@ class WGCNA(GeneExp):
         :type nBreaks: int
         :param blockSize: block size into which the calculation of connectivity should be broken up. If not given, a suitable value will be calculated using function blockSize and printed if verbose>0. If R runs into memory problems, decrease this value.
         :type blockSize: int
-        :param corOptions: a list giving further options to the correlation function specified in corFnc.
+        :param corOptions: not used, the correlation is always Pearson; kept for backward compatibility.
         :type corOptions: list
         :param networkType: network type. Allowed values are (unique abbreviations of) "unsigned", "signed", "signed hybrid". (default = unsigned)
         :type networkType: str
@@ -808,6 +994,10 @@ class WGCNA(GeneExp):
         :type moreNetworkConcepts: bool
         :param gcInterval: a number specifying in interval (in terms of individual genes) in which garbage collection will be performed. The actual interval will never be less than blockSize.
         :type gcInterval: int
+        :param lowMemory: compute each correlation on the fly inside the connectivity kernel instead of storing a correlation matrix for every block, so memory does not grow with blockSize. Requires numba and expression data; slower than the default when the blocks fit in memory. (default = False)
+        :type lowMemory: bool
+        :param _Z: standardized expression data as returned by _standardizedExpr(data), for callers that already computed it. (default = None)
+        :type _Z: ndarray
 
         :return: tuple including powerEstimate: estimate of an appropriate soft-thresholding power which is the lowest power for which the scale free topology fit \(R^2\) exceeds RsquaredCut and conectivity is less than MeanCut. If \(R^2\) is below RsquaredCut for all powers maximum will re returned and datout which is a data frame containing the fit indices for scale free topology. The columns contain the soft-thresholding power, adjusted \(R^2\) for the linear fit, the linear coefficient, adjusted \(R^2\) for a more complicated fit models, mean connectivity, median connectivity and maximum connectivity. If input moreNetworkConcepts is TRUE, 3 additional columns containing network density, centralization, and heterogeneity.
         :type: int and pandas dataframe
@@ -831,6 +1021,12 @@ class WGCNA(GeneExp):
             if any(np.diag(data) != 1):
                 data = np.where(np.diag(data), 1)
 
+        if lowMemory and (njit is None or not dataIsExpr):
+            print(f"{WARNING}'lowMemory' requires numba and expression data; it will be ignored.{ENDC}")
+            lowMemory = False
+        if lowMemory and blockSize is None:
+            blockSize = nGenes
+
         if blockSize is None:
             blockSize = WGCNA.calBlockSize(nGenes, rectangularBlocks=True, maxMemoryAllocation=2 ** 30)
             print("will use block size ", blockSize, flush=True)
@@ -841,96 +1037,115 @@ class WGCNA(GeneExp):
         colname1 = ["Power", "SFT.R.sq", "slope", "truncated R.sq", "mean(k)", "median(k)", "max(k)"]
 
         if moreNetworkConcepts:
-            colname1 = colname1.append(["Density", "Centralization", "Heterogeneity"])
-
-        datout = pd.DataFrame(np.full((len(powerVector), len(colname1)), 666), columns=colname1, dtype=object)
-        datout['Power'] = powerVector
+            colname1.extend(["Density", "Centralization", "Heterogeneity"])
 
-        datk = np.zeros((nGenes, len(powerVector)))
+        # correlations and connectivities are kept in single precision, which halves the memory of each block
+        datk = np.zeros((nGenes, len(powerVector)), dtype=np.float32)
         nPowers = len(powerVector)
-        startG = 0
         lastGC = 0
-        if corOptions is None:
-            corOptions = pd.DataFrame()
-            corOptions['x'] = [data]
-        else:
-            corOptions['x'] = [data]
+
+        if corOptions is not None:
+            print(f"{WARNING}'corOptions' is not used by pickSoftThreshold and will be ignored.{ENDC}")
 
         if weights is not None:
             if not dataIsExpr:
                 sys.exit("Weights can only be used when 'data' represents expression data ('dataIsExpr' must be TRUE).")
             if data.shape != weights.shape:
                 sys.exit("When 'weights' are given, dimensions of 'data' and 'weights' must be the same.")
-            corOptions['weights.x'] = weights
 
-        while startG < nGenes:
-            endG = min(startG + blockSize, nGenes)
+        if dataIsExpr:
+            # standardize genes once so the correlation of each block is a single matrix product. Genes are stored
+            # as rows so each block is a contiguous slice of rows.
+            nSamples = data.shape[0]
+            if _Z is None:
+                _Z = WGCNA._standardizedExpr(data)
+            Zt = np.ascontiguousarray(_Z.T, dtype=np.float32)
+            del _Z
+
+        powerVector1 = [0]
+        powerVector1.extend(powerVector[:-1])
+        powerSteps = powerVector - powerVector1
 
-            useGenes = list(range(startG, endG))
-            nGenes1 = len(useGenes)
+        def blockCorx(startG, endG, buf):
+            if not dataIsExpr:
+                return data.iloc[:, startG:endG].to_numpy(dtype=np.float32)
+            corx = buf[:nGenes * (endG - startG)].reshape(nGenes, endG - startG)
+            np.dot(Zt, Zt[startG:endG].T, out=corx)
+            corx /= nSamples - 1
+            if intType == 0:
+                np.abs(corx, out=corx)
+            elif intType == 1:
+                np.multiply(corx, 0.5, out=corx)
+                np.add(corx, 0.5, out=corx)
+            elif intType == 2:
+                corx[corx < 0] = 0
+            return corx
+
+        blocks = [(startG, min(startG + blockSize, nGenes)) for startG in range(0, nGenes, blockSize)]
+        if lowMemory:
+            if np.isnan(Zt).any():
+                print(f"{WARNING}Some correlations are NA.{ENDC}")
+            for startG, endG in blocks:
+                datk[startG:endG, :] = _block_k(Zt, powerSteps, startG, endG, intType)
+        else:
+            # the correlations of the next block are computed in a worker thread (BLAS releases the GIL) while the
+            # connectivity of the current block is accumulated, alternating between two preallocated buffers
+            bufs = [None, None]
             if dataIsExpr:
-                corOptions['y'] = [data.iloc[:, useGenes]]
-                if weights is not None:
-                    corOptions['weights.y'] = [weights.iloc[:, useGenes]]
-                corx = np.corrcoef(corOptions.x[0], corOptions.y[0], rowvar=False)
-                corx = corx[0:corOptions.x[0].shape[1], useGenes]
-                if intType == 0:
-                    corx = abs(corx)
-                elif intType == 1:
-                    corx = (1 + corx) / 2
-                elif intType == 2:
-                    corx[corx < 0] = 0
-
-                if np.count_nonzero(np.isnan(corx)) != 0:
-                    print(
-                        f"{WARNING}Some correlations are NA in block {str(startG)} : {str(endG)}.{ENDC}")
-            else:
-                corx = data.iloc[:, useGenes].to_numpy()
-
-            corx[useGenes, list(range(len(useGenes)))] = 1
-            datk_local = np.empty((nGenes1, nPowers))
-            datk_local[:] = np.nan
-            corxPrev = np.ones(corx.shape)
-            powerVector1 = [0]
-            powerVector1.extend(powerVector[:-1])
-            powerSteps = powerVector - powerVector1
-            uniquePowerSteps = np.unique(powerSteps)
-
-            def func(power):
-                return corx ** power
-
-            corxPowers = pd.DataFrame()
-            for p in uniquePowerSteps:
-                corxPowers[p] = [func(p)]
-
-            for j in range(nPowers):
-                corxCur = corxPrev * corxPowers[powerSteps[j]][0]
-                datk_local[:, j] = np.nansum(corxCur, axis=0) - 1
-                corxPrev = corxCur
-
-            datk[startG:endG, :] = datk_local
-
-            startG = endG
-            if 0 < gcInterval < startG - lastGC:
-                lastGC = startG
-
-        for i in range(len(powerVector)):
-            khelp = datk[:, i]
-            SFT1 = WGCNA.scaleFreeFitIndex(k=khelp, nBreaks=nBreaks)
-            datout.loc[i, 'SFT.R.sq'] = SFT1.loc[0, 'Rsquared.SFT']
-            datout.loc[i, 'slope'] = SFT1.loc[0, 'slope.SFT']
-            datout.loc[i, 'truncated R.sq'] = SFT1.loc[0, 'truncatedExponentialAdjRsquared']
-            datout.loc[i, 'mean(k)'] = statistics.mean(khelp)
-            datout.loc[i, 'median(k)'] = statistics.median(khelp)
-            datout.loc[i, 'max(k)'] = max(khelp)
-
-            if moreNetworkConcepts:
-                Density = sum(khelp) / (nGenes * (nGenes - 1))
-                datout.loc[i, 'Density'] = Density
-                Centralization = nGenes * (max(khelp) - statistics.mean(khelp)) / ((nGenes - 1) * (nGenes - 2))
-                datout.loc[i, 'Centralization'] = Centralization
-                Heterogeneity = np.sqrt(nGenes * sum(khelp ^ 2) / sum(khelp) ^ 2 - 1)
-                datout.loc[i, 'Heterogeneity'] = Heterogeneity
+                bufs = [np.empty(nGenes * min(blockSize, nGenes), dtype=np.float32) for _ in range(2)]
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                nextCorx = executor.submit(blockCorx, *blocks[0], bufs[0])
+                for b, (startG, endG) in enumerate(blocks):
+                    corx = nextCorx.result()
+                    if b + 1 < len(blocks):
+                        nextCorx = executor.submit(blockCorx, *blocks[b + 1], bufs[(b + 1) % 2])
+
+                    nGenes1 = endG - startG
+                    if dataIsExpr and np.count_nonzero(np.isnan(corx)) != 0:
+                        print(
+                            f"{WARNING}Some correlations are NA in block {str(startG)} : {str(endG)}.{ENDC}")
+
+                    corx[range(startG, endG), range(nGenes1)] = 1
+                    # missing correlations do not contribute to the connectivity
+                    np.nan_to_num(corx, copy=False, nan=0)
+
+                    if njit is not None:
+                        datk_local = _accumulate_k(corx, powerSteps)
+                    else:
+                        # walk the sorted powers, multiplying in one step at a time into a reused buffer
+                        datk_local = np.empty((nGenes1, nPowers))
+                        corxCur = np.empty_like(corx)
+                        scratch = np.empty_like(corx)
+                        np.power(corx, powerVector[0], out=corxCur)
+                        datk_local[:, 0] = corxCur.sum(axis=0, dtype=np.float64) - 1
+                        for j in range(1, nPowers):
+                            np.power(corx, powerSteps[j], out=scratch)
+                            np.multiply(corxCur, scratch, out=corxCur)
+                            datk_local[:, j] = corxCur.sum(axis=0, dtype=np.float64) - 1
+
+                    datk[startG:endG, :] = datk_local
+
+                    if 0 < gcInterval < endG - lastGC:
+                        lastGC = endG
+
+        # all powers are summarized at once, in double precision
+        datk = datk.astype(np.float64)
+        SFT = WGCNA.scaleFreeFitIndexBatch(datk, nBreaks=nBreaks)
+        results = np.empty((nPowers, len(colname1)))
+        results[:, 0] = powerVector
+        results[:, 1:4] = SFT[['Rsquared.SFT', 'slope.SFT', 'truncatedExponentialAdjRsquared']].to_numpy()
+        results[:, 4] = datk.mean(axis=0)
+        results[:, 5] = np.median(datk, axis=0)
+        results[:, 6] = datk.max(axis=0)
+
+        if moreNetworkConcepts:
+            results[:, 7] = datk.sum(axis=0) / (nGenes * (nGenes - 1))
+            results[:, 8] = nGenes * (results[:, 6] - results[:, 4]) / ((nGenes - 1) * (nGenes - 2))
+            results[:, 9] = np.sqrt(nGenes * (datk ** 2).sum(axis=0) / datk.sum(axis=0) ** 2 - 1)
+
+        datout = pd.DataFrame(results, columns=colname1)
+        # keep the powers as given (e.g. integers) rather than as floats
+        datout['Power'] = powerVector
 
         print(datout)
 
@@ -1007,38 +1222,81 @@ class WGCNA(GeneExp):
         :param nBreaks: (default = 10)
         :type nBreaks: int
         """
-        df = pd.DataFrame({'data': k})
-        df['discretized_k'] = pd.cut(df['data'], nBreaks)
-        dk = df.groupby('discretized_k').mean()  # tapply(k, discretized_k, mean)
-        dk = pd.DataFrame(dk.reset_index())
-        dk.columns = ['discretized_k', 'dk']
-        p_dk = df['discretized_k'].value_counts() / len(k)  # as.vector(tapply(k, discretized.k, length)/length(k))
-        p_dk = pd.DataFrame(p_dk.reset_index())
-        p_dk.columns = ['discretized_k', 'p_dk']
-        breaks1 = np.linspace(start=min(k), stop=max(k), num=nBreaks + 1)
-        y, edges = np.histogram(df['data'], bins=breaks1)
-        dk2 = 0.5 * (edges[1:] + edges[:-1])
-        df = pd.merge(dk, p_dk, on='discretized_k')
-        if df['dk'].isnull().values.any():
-            df.loc[df['dk'].isnull().values, 'dk'] = dk2[df['dk'].isnull().values]
-        if np.any(df['dk'] == 0):
-            df.loc[df['dk'] == 0, 'dk'] = dk2[df['dk'] == 0]
-        if df['p_dk'].isnull().values.any():
-            df.loc[df['p_dk'].isnull().values, 'p_dk'] = 0
-        df['log_dk'] = np.log10(df['dk'])
-        df['log_p_dk'] = np.log10(df['p_dk'] + 1e-09)
-        df['log_p_dk_10'] = np.power(10, df['log_dk'])
-
-        model1 = ols(formula='log_p_dk ~ log_dk', data=df).fit()
-        model2 = ols(formula='log_p_dk ~ log_dk + log_p_dk_10', data=df).fit()
-        dfout = pd.DataFrame({'Rsquared.SFT': [model1.rsquared],
-                              'slope.SFT': [model1.params.values[1]],
-                              'truncatedExponentialAdjRsquared': [model2.rsquared_adj]})
+        return WGCNA.scaleFreeFitIndexBatch(np.asarray(k, dtype=np.float64)[:, None], nBreaks=nBreaks)
+
+    @staticmethod
+    def scaleFreeFitIndexBatch(datk, nBreaks=10):
+        """
+        calculates the fitting statistics of scaleFreeFitIndex for several connectivity vectors at once.
+
+        :param datk: connectivities whose components contain non-negative values, one column per soft thresholding power
+        :type datk: ndarray
+        :param nBreaks: (default = 10)
+        :type nBreaks: int
+
+        :return: fitting statistics with one row per column of datk
+        :rtype: pandas dataframe
+        """
+        datk = np.asarray(datk, dtype=np.float64)
+        nGenes, nPowers = datk.shape
+        breaks1 = np.linspace(start=datk.min(axis=0), stop=datk.max(axis=0), num=nBreaks + 1)
+        dk2 = 0.5 * (breaks1[1:] + breaks1[:-1])
+        # right-closed bins as in pd.cut, the first bin also holds the minimum
+        discretized_k = np.empty(datk.shape, dtype=np.intp)
+        for i in range(nPowers):
+            discretized_k[:, i] = np.digitize(datk[:, i], breaks1[1:-1, i], right=True)
+        # offset the bins of each power so one bincount covers all of them
+        discretized_k += np.arange(nPowers) * nBreaks
+        counts = np.bincount(discretized_k.ravel(), minlength=nBreaks * nPowers).reshape(nPowers, nBreaks).T
+        sums = np.bincount(discretized_k.ravel(), weights=datk.ravel(),
+                           minlength=nBreaks * nPowers).reshape(nPowers, nBreaks).T
+        dk = sums / np.maximum(counts, 1)
+        p_dk = counts / nGenes
+        # empty bins (and bins with zero mean) are represented by their midpoints
+        dk = np.where(np.logical_or(counts == 0, dk == 0), dk2, dk)
+        log_dk = np.log10(dk)
+        log_p_dk = np.log10(p_dk + 1e-09)
+        y = log_p_dk - log_p_dk.mean(axis=0)
+        tss = np.sum(y ** 2, axis=0)
+
+        # log_p_dk ~ log_dk
+        x = log_dk - log_dk.mean(axis=0)
+        sxx = np.sum(x ** 2, axis=0)
+        # a constant log_dk (e.g. constant connectivity) has no fit, report slope and R^2 of 0 instead of NaN
+        constant = sxx == 0
+        slope = np.sum(x * y, axis=0) / np.where(constant, 1, sxx)
+        rsquared = np.where(constant, 0, 1 - np.sum((y - slope * x) ** 2, axis=0) / tss)
+
+        # log_p_dk ~ log_dk + dk
+        rsquared2_adj = np.empty(nPowers)
+        for i in range(nPowers):
+            X = np.column_stack((np.ones(nBreaks), log_dk[:, i], dk[:, i]))
+            coef, _, rank, _ = np.linalg.lstsq(X, log_p_dk[:, i], rcond=None)
+            rsquared2 = 1 - np.sum((log_p_dk[:, i] - X @ coef) ** 2) / tss[i]
+            rsquared2_adj[i] = 1 - (nBreaks - 1) / (nBreaks - rank) * (1 - rsquared2)
+
+        dfout = pd.DataFrame({'Rsquared.SFT': rsquared,
+                              'slope.SFT': slope,
+                              'truncatedExponentialAdjRsquared': rsquared2_adj})
         return dfout
 
+    @staticmethod
+    def _standardizedExpr(datExpr):
+        """
+        standardize each gene (column) of the expression data to zero mean and unit variance.
+
+        :param datExpr: data frame containing expression data. Columns correspond to genes and rows to samples.
+        :type datExpr: pandas dataframe
+
+        :return: C-contiguous standardized expression matrix
+        :rtype: ndarray
+        """
+        arr = np.asarray(datExpr, dtype=np.float64)
+        return np.ascontiguousarray((arr - arr.mean(axis=0)) / arr.std(axis=0, ddof=1))
+
     @staticmethod
     def adjacency(datExpr, selectCols=None, adjacencyType="unsigned", power=6, corOptions=pd.DataFrame(), weights=None,
-                  weightArgNames=None):
+                  weightArgNames=None, _Z=None):
         """
         Calculates (correlation or distance) network adjacency from given expression data or from a similarity
 
@@ -1050,58 +1308,52 @@ class WGCNA(GeneExp):
         :type adjacencyType: str
         :param power: soft thresholding power.
         :type power: int
-        :param corOptions: specifying additional arguments to be passed to the function given by corFnc.
+        :param corOptions: not used, the correlation is always Pearson; kept for backward compatibility.
         :type corOptions: pandas dataframe
-        :param weights: optional observation weights for datExpr to be used in correlation calculation. A matrix of the same dimensions as datExpr, containing non-negative weights. Only used with Pearson correlation.
+        :param weights: optional observation weights for datExpr. They are checked but not used yet, the correlation is unweighted.
         :type weights: pandas dataframe
-        :param weightArgNames: character list of length 2 giving the names of the arguments to corFnc that represent weights for variable x and y. Only used if weights are non-NULL.
+        :param weightArgNames: not used; kept for backward compatibility.
         :type weightArgNames: list
+        :param _Z: standardized expression data as returned by _standardizedExpr(datExpr), for callers that already computed it. (default = None)
+        :type _Z: ndarray
 
         :return: Adjacency matrix
         :rtype: pandas dataframe
         """
         print(f"{OKCYAN}calculating adjacency matrix ...{ENDC}")
-        if weightArgNames is None:
-            weightArgNames = ["weights.x", "weights.y"]
         intType = adjacencyTypes.index(adjacencyType)
         if intType is None:
             sys.exit(("Unrecognized 'type'. Recognized values are", str(adjacencyTypes)))
+        # weights are only validated, the weighted correlation is not implemented (as in pickSoftThreshold)
         weights = WGCNA.checkAndScaleWeights(weights, datExpr, scaleByMax=False)
         if weights is not None:
-            if selectCols is None:
-                if isinstance(corOptions, pd.DataFrame):
-                    weightOpt = pd.DataFrame({'weights.x': weights})
-                    weightOpt.index = weightArgNames[0]
-                else:
-                    weightOpt = weightArgNames[0] + " = weights"
-            else:
-                if isinstance(corOptions, pd.DataFrame):
-                    weightOpt = pd.DataFrame({'weights.x': weights, 'weights.y': weights[:, selectCols]})
-                    weightOpt.index = weightArgNames[0:2]
-                else:
-                    weightOpt = weightArgNames[1] + " = weights, " + weightArgNames[2] + " = weights[, selectCols]"
-        else:
-            if isinstance(corOptions, pd.DataFrame):
-                weightOpt = pd.DataFrame()
-            else:
-                weightOpt = ""
-
+            print(f"{WARNING}'weights' are not used by adjacency and will be ignored; the unweighted Pearson "
+                  f"correlation is calculated.{ENDC}")
+        if corOptions is not None and len(corOptions) > 0:
+            print(f"{WARNING}'corOptions' is not used by adjacency and will be ignored.{ENDC}")
+        if weightArgNames is not None:
+            print(f"{WARNING}'weightArgNames' is not used by adjacency and will be ignored.{ENDC}")
+
+        # Pearson correlation as a single product of the standardized expression matrix
+        Z = WGCNA._standardizedExpr(datExpr) if _Z is None else _Z
         if selectCols is None:
-            cor_mat = np.corrcoef(
-                datExpr.T)  # cor_mat = do.call(corFnc.fnc, c(list(x = datExpr), weightOpt, corOptions))
+            cor_mat = Z.T @ Z  # cor_mat = do.call(corFnc.fnc, c(list(x = datExpr), weightOpt, corOptions))
         else:
-            cor_mat = np.corrcoef(x=datExpr, y=datExpr[:, selectCols])  # , weightOpt, corOptions)
+            cor_mat = Z.T @ Z[:, selectCols]  # , weightOpt, corOptions)
+        cor_mat /= Z.shape[0] - 1
+        np.clip(cor_mat, -1, 1, out=cor_mat)
 
         if intType == 0:
-            cor_mat = abs(cor_mat)
+            np.abs(cor_mat, out=cor_mat)
         elif intType == 1:
-            cor_mat = (1 + cor_mat) / 2
+            np.multiply(cor_mat, 0.5, out=cor_mat)
+            np.add(cor_mat, 0.5, out=cor_mat)
         elif intType == 2:
             cor_mat[cor_mat < 0] = 0
 
         print("\tDone..\n")
 
-        return cor_mat ** power
+        return np.power(cor_mat, power, out=cor_mat)
 
     @staticmethod
     def checkAdjMat(adjMat, min=0, max=1):
@@ -2785,6 +3037,34 @@ class WGCNA(GeneExp):
 
         return datTraits
 
+    @staticmethod
+    def corPvalueStudent(cor, nSamples, alternative='two-sided'):
+        """
+        Calculates Student asymptotic p-value for given correlations.
+
+        :param cor: correlation values
+        :type cor: ndarray
+        :param nSamples: number of samples from which the correlations were calculated
+        :type nSamples: int
+        :param alternative: Defines the alternative hypothesis. Default is ‘two-sided’. The following options are available: 'two-sided’: the correlation is nonzero, ‘less’: the correlation is negative (less than zero), ‘greater’: the correlation is positive (greater than zero)
+        :type alternative: str
+
+        :return: p-values of the same shape as cor
+        :rtype: ndarray
+        """
+        cor = np.asarray(cor, dtype=np.float64)
+        df = nSamples - 2
+        tstat = cor * np.sqrt(df / (1 - cor ** 2))
+        # stdtr is the Student t CDF, called directly instead of through scipy.stats.t
+        if alternative == 'two-sided':
+            return 2.0 * stdtr(df, -np.abs(tstat))
+        elif alternative == 'greater':
+            return stdtr(df, -tstat)
+        elif alternative == 'less':
+            return stdtr(df, tstat)
+        else:
+            sys.exit("alternative must be one of 'two-sided', 'less' or 'greater'.")
+
     def module_trait_relationships_heatmap(self,
                                            metaData,
                                            alternative='two-sided',
@@ -2814,11 +3094,14 @@ class WGCNA(GeneExp):
                                          columns=datTraits.columns,
                                          dtype="float")
 
-        for i in self.MEs.columns:
-            for j in datTraits.columns:
-                tmp = stats.pearsonr(self.MEs[i], datTraits[j], alternative=alternative)
-                moduleTraitCor.loc[i, j] = tmp[0]
-                moduleTraitPvalue.loc[i, j] = tmp[1]
+        # all module-trait correlations at once from the standardized eigengenes and traits
+        MEs = np.asarray(self.MEs, dtype=np.float64)
+        traits = np.asarray(datTraits, dtype=np.float64)
+        MEs = (MEs - MEs.mean(axis=0)) / MEs.std(axis=0, ddof=1)
+        traits = (traits - traits.mean(axis=0)) / traits.std(axis=0, ddof=1)
+        cor = np.clip(MEs.T @ traits / (MEs.shape[0] - 1), -1, 1)
+        moduleTraitCor.loc[:, :] = cor
+        moduleTraitPvalue.loc[:, :] = WGCNA.corPvalueStudent(cor, MEs.shape[0], alternative=alternative)
 
         if set(metaData) == set(self.datExpr.obs.columns.tolist()):
             self.moduleTraitCor = moduleTraitCor
@@ -17,7 +17,6 @@ setup(
         'numpy>=1.24.0',  # base python distribution
         'scipy>=1.9.1',
         'scikit-learn>=1.2.2',
-        'statsmodels>=0.14.0',
         'matplotlib>=3.9.1',
         'seaborn>=0.11.2',
         'biomart>=0.9.2',
@@ -33,6 +32,10 @@ setup(
         'psutil>=5.9.0',
         'requests>=2.28.1',
     ],
+    extras_require={
+        'numba': ['numba>=0.57.0'],  # optional, speeds up pickSoftThreshold
+        'numexpr': ['numexpr>=2.8.4'],  # optional, speeds up goodSamplesGenes
+    },
     classifiers=[  # choose from here: https://pypi.org/classifiers/
         'Development Status :: 3 - Alpha',
         'Intended Audience :: Science/Research ',